@@ -1,12 +1,29 @@
 import os
 import json
+import asyncio
+import aiohttp
+import re
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import base64
 from PIL import Image, ImageDraw
 from io import BytesIO
+import numpy as np
+from numba import njit
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import time
+import xxhash
+from collections import OrderedDict
+
+try:
+    import torch
+    from transformers import AutoImageProcessor, AutoModelForObjectDetection
+except ImportError:
+    torch = None
 
 # ==== SETTINGS & CONFIGURATION ====
 BASE_URL = "https://api.mistall.com/v3/frame/5113/Cam{}"
@@ -14,8 +31,13 @@ HEADERS = {"User-Agent": "Mozilla/5.0"}
 IMAGES_DIR = "images"
 LOT_MAP_PATH = "lot_map_cartoon.png"
 SPOTS_FILE = "parking_spots.json"
+IMG_DATA_URI_RE = re.compile(rb'src="(data:image/[^"]+)"')
 
 HF_API_URL = "https://api-inference.huggingface.co/models/facebook/detr-resnet-50"
+LOCAL_DETECTOR_MODEL = "hustvl/yolos-tiny"
+DETECTION_CACHE_SIZE = 128
+HF_MAX_IMAGE_SIZE = (800, 800)
+SPOT_WIDTH, SPOT_HEIGHT, SPOT_RADIUS = 12, 28, 5
 
 try:
     HF_API_TOKEN = st.secrets["HF_API_TOKEN"]
@@ -26,92 +48,253 @@ except KeyError:
     st.error("HF_API_TOKEN not found in secrets.toml. Please add it.")
     st.stop()
 
+@st.cache_resource
 def load_spots_config(file_path):
     try:
         with open(file_path, 'r') as f:
-            return json.load(f)
+            spots_data = json.load(f)
     except Exception as e:
         st.error(f"Failed to load spots config: {e}")
         st.stop()
 
-def fetch_cam_image(cam_num):
+    # Polygons are static: convert them once to contiguous float32 x/y arrays and bounding
+    # boxes, rasterize each one, and only look vehicle centers up per frame
+    for data in spots_data.values():
+        polygons_np = [np.asarray(polygon, dtype=np.float32) for polygon in data.get("polygons", [])]
+        data["poly_xs"] = [points[:, 0].copy() for points in polygons_np]
+        data["poly_ys"] = [points[:, 1].copy() for points in polygons_np]
+        data["bboxes"] = np.array([
+            [xs.min(), ys.min(), xs.max(), ys.max()] for xs, ys in zip(data["poly_xs"], data["poly_ys"])
+        ], dtype=np.float32).reshape(-1, 4)
+        data["spot_masks"] = [rasterize_polygon(xs, ys) for xs, ys in zip(data["poly_xs"], data["poly_ys"])]
+    return spots_data
+
+def decode_cam_image(cam_num, content):
+    match = IMG_DATA_URI_RE.search(content)
+    if not match:
+        return None
+    base64_data = match.group(1).split(b",", 1)[1]
+    image_data = base64.b64decode(base64_data)
+    img = Image.open(BytesIO(image_data)).convert("RGB")
+
+    # Detection works on the in-memory image; the snapshot on disk is only for reference
+    path = os.path.join(IMAGES_DIR, f"cam{cam_num}_snapshot.jpg")
+    threading.Thread(target=img.save, args=(path, "JPEG"), kwargs={"quality": 85}, daemon=True).start()
+    return img
+
+async def _fetch_cam_async(session, cam_num):
     url = BASE_URL.format(cam_num)
     try:
-        response = requests.get(url, headers=HEADERS, timeout=10)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as e:
+        async with session.get(url) as response:
+            response.raise_for_status()
+            content = await response.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
         st.warning(f"Could not fetch camera {cam_num} image. Error: {e}")
         return None
 
-    soup = BeautifulSoup(response.text, "html.parser")
-    img_tag = soup.find("img")
-    if img_tag and 'src' in img_tag.attrs and img_tag['src'].startswith("data:image"):
-        base64_data = img_tag['src'].split(",")[1]
-        image_data = base64.b64decode(base64_data)
-        img = Image.open(BytesIO(image_data))
-        path = os.path.join(IMAGES_DIR, f"cam{cam_num}_snapshot.png")
-        img.save(path, "PNG")
-        return path
-    return None
+    # Decoding is CPU-bound, keep it off the event loop
+    return await asyncio.to_thread(decode_cam_image, cam_num, content)
 
-def hf_detect_objects(image: Image.Image):
-    buffered = BytesIO()
-    image.save(buffered, format="PNG")
-    img_bytes = buffered.getvalue()
+async def fetch_cam_images(cam_nums):
+    timeout = aiohttp.ClientTimeout(total=10)
+    async with aiohttp.ClientSession(headers=HEADERS, timeout=timeout) as session:
+        return await asyncio.gather(*[_fetch_cam_async(session, n) for n in cam_nums])
+
+@st.cache_resource
+def get_http_session():
+    # Shared across reruns and sessions so TCP/TLS connections to the API are reused
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=16, max_retries=Retry(total=2, backoff_factor=0.3))
+    session.mount("https://", adapter)
+    return session
 
+@st.cache_data(ttl=300, max_entries=64, show_spinner=False)
+def _hf_detect_cached(img_hash, _img_bytes):
+    # Keyed on img_hash only; failures raise so they are never cached
     headers = {
         "Authorization": f"Bearer {HF_API_TOKEN}",
-        "Content-Type": "image/png",
+        "Content-Type": "image/jpeg",
+        "X-Use-Cache": "true",
     }
+    response = get_http_session().post(HF_API_URL, headers=headers, data=_img_bytes, timeout=30)
+    response.raise_for_status()
+    return response.json()
+
+def scale_boxes(detected_objects, scale_x, scale_y):
+    scaled = []
+    for obj in detected_objects:
+        if isinstance(obj, dict) and "box" in obj:
+            box = obj["box"]
+            obj = {**obj, "box": {
+                "xmin": box["xmin"] * scale_x, "ymin": box["ymin"] * scale_y,
+                "xmax": box["xmax"] * scale_x, "ymax": box["ymax"] * scale_y,
+            }}
+        scaled.append(obj)
+    return scaled
+
+def hf_detect_objects(image: Image.Image):
+    # The model resizes to ~800px anyway, so downscale before encoding and uploading
+    upload = image.convert("RGB")
+    upload.thumbnail(HF_MAX_IMAGE_SIZE, Image.BILINEAR)
+    buffered = BytesIO()
+    upload.save(buffered, format="JPEG", quality=85, optimize=False)
+    img_bytes = buffered.getvalue()
+
     try:
-        response = requests.post(HF_API_URL, headers=headers, data=img_bytes, timeout=30)
-        response.raise_for_status()
-        return response.json()
+        detected_objects = _hf_detect_cached(xxhash.xxh64(img_bytes).hexdigest(), img_bytes)
     except requests.exceptions.RequestException as e:
         st.warning(f"API request failed: {e}")
         try:
-            st.warning(f"API Response Details: {response.json()}")
+            st.warning(f"API Response Details: {e.response.json()}")
         except:
             pass
         return []
 
-def check_overlap(box, polygon):
-    box_center_x = (box['xmin'] + box['xmax']) / 2
-    box_center_y = (box['ymin'] + box['ymax']) / 2
-
-    num_vertices = len(polygon)
-    is_inside = False
-    p1x, p1y = polygon[0]
-    for i in range(num_vertices + 1):
-        p2x, p2y = polygon[i % num_vertices]
-        if box_center_y > min(p1y, p2y) and box_center_y <= max(p1y, p2y) and box_center_x <= max(p1x, p2x):
-            if p1y != p2y:
-                x_intersection = (box_center_y - p1y) * (p2x - p1x) / (p2y - p1y) + p1x
-            if p1x == p2x or box_center_x <= x_intersection:
-                is_inside = not is_inside
-        p1x, p1y = p2x, p2y
-    return is_inside
-
-def detect_occupancy(image_path, polygons):
-    img = Image.open(image_path)
-    all_detected_objects = hf_detect_objects(img)
+    if upload.size == image.size:
+        return detected_objects
+    return scale_boxes(detected_objects, image.width / upload.width, image.height / upload.height)
+
+@st.cache_resource
+def load_local_detector():
+    # FP16 + compiled kernels on GPU, dynamic INT8 linear layers on CPU
+    if torch is None:
+        return None
+    processor = AutoImageProcessor.from_pretrained(LOCAL_DETECTOR_MODEL)
+    if torch.cuda.is_available():
+        device, dtype = "cuda", torch.float16
+        model = AutoModelForObjectDetection.from_pretrained(LOCAL_DETECTOR_MODEL, torch_dtype=dtype).to(device).eval()
+        model = torch.compile(model, mode="reduce-overhead")
+    else:
+        device, dtype = "cpu", torch.float32
+        model = AutoModelForObjectDetection.from_pretrained(LOCAL_DETECTOR_MODEL).eval()
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return processor, model, device, dtype
+
+@st.cache_resource
+def local_detection_cache():
+    return OrderedDict(), threading.Lock()
+
+def _run_local_detector(images):
+    processor, model, device, dtype = load_local_detector()
+    inputs = processor(images=images, return_tensors="pt").to(device, dtype=dtype)
+    with torch.inference_mode():
+        outputs = model(**inputs)
+    results = processor.post_process_object_detection(
+        outputs, threshold=0.7, target_sizes=[img.size[::-1] for img in images]
+    )
+
+    # Same shape as the HF Inference API response
+    return [
+        [
+            {
+                "label": model.config.id2label[label.item()],
+                "score": score.item(),
+                "box": dict(zip(("xmin", "ymin", "xmax", "ymax"), box.tolist())),
+            }
+            for score, label, box in zip(result["scores"], result["labels"], result["boxes"])
+        ]
+        for result in results
+    ]
+
+def detect_batch(images):
+    cache, lock = local_detection_cache()
+    images = [img.convert("RGB") for img in images]
+    keys = [xxhash.xxh64(img.tobytes()).hexdigest() for img in images]
+
+    # Only frames that changed since they were last seen go through the model
+    with lock:
+        misses = [i for i, key in enumerate(keys) if key not in cache]
+    if misses:
+        results = _run_local_detector([images[i] for i in misses])
+
+    with lock:
+        if misses:
+            cache.update((keys[i], result) for i, result in zip(misses, results))
+        for key in keys:
+            cache.move_to_end(key)
+        while len(cache) > DETECTION_CACHE_SIZE:
+            cache.popitem(last=False)
+        return [cache[key] for key in keys]
+
+def detect_objects(images):
+    if not images:
+        return []
+    if load_local_detector() is not None:
+        return detect_batch(images)
+
+    # One API round-trip per camera, all in flight at once; workers share this run's
+    # script context so their st.warning calls still reach the page
+    with ThreadPoolExecutor(
+        max_workers=len(images), initializer=add_script_run_ctx, initargs=(None, get_script_run_ctx())
+    ) as executor:
+        return list(executor.map(hf_detect_objects, images))
+
+@njit(cache=True, fastmath=True)
+def _pip_numba(cx, cy, poly_x, poly_y):
+    # Even-odd ray cast of every (cx[k], cy[k]) against one polygon
+    num_vertices = poly_x.shape[0]
+    inside = np.zeros(cx.shape[0], dtype=np.bool_)
+    for k in range(cx.shape[0]):
+        x, y = cx[k], cy[k]
+        is_inside = False
+        p1x, p1y = poly_x[num_vertices - 1], poly_y[num_vertices - 1]
+        for i in range(num_vertices):
+            p2x, p2y = poly_x[i], poly_y[i]
+            # Horizontal edges never cross the ray; skip them before computing the intersection
+            if p1y != p2y and y > min(p1y, p2y) and y <= max(p1y, p2y) and x <= max(p1x, p2x):
+                x_intersection = (y - p1y) * (p2x - p1x) / (p2y - p1y) + p1x
+                if p1x == p2x or x <= x_intersection:
+                    is_inside = not is_inside
+            p1x, p1y = p2x, p2y
+        inside[k] = is_inside
+    return inside
+
+def rasterize_polygon(poly_x, poly_y):
+    # Sample the ray cast at every whole-pixel coordinate of the polygon's bounding box, the
+    # same points detect_occupancy looks up with floor(cx), floor(cy); whole-number centers
+    # match the ray cast exactly, fractional ones are classified at their floored pixel
+    x0, y0 = int(np.floor(poly_x.min())), int(np.floor(poly_y.min()))
+    x1, y1 = int(np.floor(poly_x.max())), int(np.floor(poly_y.max()))
+    xs, ys = np.meshgrid(np.arange(x0, x1 + 1, dtype=np.float32), np.arange(y0, y1 + 1, dtype=np.float32))
+    inside = _pip_numba(xs.ravel(), ys.ravel(), poly_x, poly_y)
+    return x0, y0, inside.reshape(xs.shape)
+
+def detect_occupancy(all_detected_objects, spot_masks, bboxes):
     vehicle_labels = {"car", "truck", "bus", "motorcycle"}
     detected_vehicles = [
         obj for obj in all_detected_objects 
         if isinstance(obj, dict) and obj.get("label") in vehicle_labels and obj.get("score", 0) > 0.7
     ]
     if not detected_vehicles:
-        return [False] * len(polygons)
+        return [False] * len(spot_masks)
 
-    occupied_status = []
-    for polygon in polygons:
-        is_occupied = any(check_overlap(vehicle['box'], polygon) for vehicle in detected_vehicles)
-        occupied_status.append(is_occupied)
+    cx = np.array([(v['box']['xmin'] + v['box']['xmax']) / 2 for v in detected_vehicles])[:, None]
+    cy = np.array([(v['box']['ymin'] + v['box']['ymax']) / 2 for v in detected_vehicles])[:, None]
+
+    # Cheap reject for every (vehicle, spot) pair at once: a center outside a spot's
+    # bounding box can't be inside the spot, so only the survivors get a mask lookup
+    candidates = (bboxes[:, 0] <= cx) & (bboxes[:, 2] >= cx) & (bboxes[:, 1] <= cy) & (bboxes[:, 3] >= cy)
+
+    occupied_status = [False] * len(spot_masks)
+    for v, idx in zip(*np.nonzero(candidates)):
+        x0, y0, mask = spot_masks[idx]
+        if mask[int(np.floor(cy[v, 0])) - y0, int(np.floor(cx[v, 0])) - x0]:
+            occupied_status[idx] = True
     return occupied_status
 
+def make_spot_mask():
+    mask = Image.new("L", (SPOT_WIDTH + 1, SPOT_HEIGHT + 1), 0)
+    ImageDraw.Draw(mask).rounded_rectangle((0, 0, SPOT_WIDTH, SPOT_HEIGHT), radius=SPOT_RADIUS, fill=255)
+    return mask
+
+# Rasterize the spot shape once; drawing a map is then one masked paste per spot
+SPOT_MASK = make_spot_mask()
+OCCUPIED_TILE = Image.new("RGBA", SPOT_MASK.size, (220, 40, 40, 180))
+FREE_TILE = Image.new("RGBA", SPOT_MASK.size, (40, 220, 40, 180))
+
 def draw_lot_map(status, spots_data):
     lot_map = Image.open(LOT_MAP_PATH).convert("RGBA")
-    draw = ImageDraw.Draw(lot_map, "RGBA")
 
     for cam, occupancy_list in status.items():
         map_spots = spots_data.get(cam, {}).get("map_spots", [])
@@ -119,29 +302,34 @@ def draw_lot_map(status, spots_data):
             if idx >= len(map_spots):
                 continue
             x, y = map_spots[idx]
-            width, height = 12, 28
-            radius = 5
-            rect = [x - width//2, y - height//2, x + width//2, y + height//2]
-            color = (220, 40, 40, 180) if occ else (40, 220, 40, 180)
-            draw.rounded_rectangle(rect, radius=radius, fill=color)
+            tile = OCCUPIED_TILE if occ else FREE_TILE
+            lot_map.paste(tile, (x - SPOT_WIDTH // 2, y - SPOT_HEIGHT // 2), SPOT_MASK)
 
     return lot_map
 
-def run_status_check(spots_data):
+async def run_status_check_async(spots_data):
     status = {}
+    cams = []
     for cam_str, data in spots_data.items():
-        cam_num = int(cam_str.replace("cam", ""))
-        polygons = data.get("polygons", [])
-        if not polygons:
+        if not data.get("polygons", []):
             status[cam_str] = []
             continue
-        cam_img_path = fetch_cam_image(cam_num)
-        if cam_img_path:
-            status[cam_str] = detect_occupancy(cam_img_path, polygons)
-        else:
-            status[cam_str] = [False] * len(polygons)
+        cams.append(cam_str)
+
+    cam_images = await fetch_cam_images([int(cam_str.replace("cam", "")) for cam_str in cams])
+    fetched = [(cam_str, img) for cam_str, img in zip(cams, cam_images) if img is not None]
+    detections = detect_objects([img for _, img in fetched])
+
+    for cam_str in cams:
+        status[cam_str] = [False] * len(spots_data[cam_str]["spot_masks"])
+    for (cam_str, _), detected_objects in zip(fetched, detections):
+        data = spots_data[cam_str]
+        status[cam_str] = detect_occupancy(detected_objects, data["spot_masks"], data["bboxes"])
     return status
 
+def run_status_check(spots_data):
+    return asyncio.run(run_status_check_async(spots_data))
+
 def main():
     st.set_page_config(page_title="Golden Spur Parking", layout="centered")
     st.title("Golden Spur Lot - USC Columbia")
@@ -154,24 +342,22 @@ def main():
     auto_update = st.checkbox("Enable automatic updates every 60 seconds")
     check_status = st.button("Check Status Now")
 
-    placeholder = st.empty()
-
-    # Run status check once on button press
-    if check_status:
-        with st.spinner("Checking parking status..."):
+    # Only this fragment reruns on the timer, so the worker is never blocked between updates
+    @st.fragment(run_every=60 if auto_update else None)
+    def lot_status():
+        if auto_update:
+            spinner_text, caption = "Automatically updating parking status...", "Live status as of {}"
+        elif check_status:
+            spinner_text, caption = "Checking parking status...", "Status at {}"
+        else:
+            return
+        with st.spinner(spinner_text):
             status = run_status_check(spots_data)
             lot_image = draw_lot_map(status, spots_data)
-            placeholder.image(lot_image, caption=f"Status at {time.strftime('%I:%M:%S %p')}")
-    
-    # Run automatic update if enabled
-    if auto_update:
-        while True:
-            with st.spinner("Automatically updating parking status..."):
-                status = run_status_check(spots_data)
-                lot_image = draw_lot_map(status, spots_data)
-                placeholder.image(lot_image, caption=f"Live status as of {time.strftime('%I:%M:%S %p')}")
-            time.sleep(60)
-    else:
+        st.image(lot_image, caption=caption.format(time.strftime('%I:%M:%S %p')))
+
+    lot_status()
+    if not auto_update:
         st.info("Press 'Check Status Now' to fetch current parking availability.")
 
 if __name__ == "__main__":
@@ -11,9 +11,13 @@ os.makedirs("images", exist_ok=True)
 base_url = "https://api.mistall.com/v3/frame/5113/Cam{}"
 headers = {"User-Agent": "Mozilla/5.0"}
 
+# Reuse one connection to the camera host across all cams
+session = requests.Session()
+session.headers.update(headers)
+
 for cam_num in range(1, 5):
     url = base_url.format(cam_num)
-    response = requests.get(url, headers=headers)
+    response = session.get(url)
     html = response.text
 
     soup = BeautifulSoup(html, "html.parser")